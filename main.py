@@ -1,49 +1,336 @@
 import os
 import io
 import re
+import json
+import string
+import asyncio
+import time
+import hashlib
+import functools
 import zipfile
-from typing import List, Tuple
+import posixpath
+import multiprocessing
+from abc import ABC, abstractmethod
+from xml.sax.saxutils import escape as xml_escape
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Iterator, List, Literal, Optional, Tuple
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.responses import StreamingResponse, JSONResponse
+import orjson
+from pydantic import BaseModel
 
 # File handling
 from docx import Document
+from lxml import etree
+from reportlab import rl_config
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import cm
+from reportlab.pdfbase.pdfmetrics import getFont, stringWidth
 
 # Optional extractors
 try:
-    from pypdf import PdfReader
+    import pymupdf
 except Exception:
-    PdfReader = None
+    try:
+        import fitz as pymupdf
+    except Exception:
+        pymupdf = None
 
 try:
     from pptx import Presentation
 except Exception:
     Presentation = None
 
+# Optional tokenizer (falls back to a ~4 chars/token estimate)
+try:
+    import tiktoken
+except Exception:
+    tiktoken = None
+
+# Optional streaming zip writer
+try:
+    from zipstream import ZipStream, ZIP_STORED
+except Exception:
+    ZipStream = None
+
+# Optional cache backend
+try:
+    from redis import asyncio as aioredis
+except Exception:
+    aioredis = None
+
+try:
+    import diskcache
+except Exception:
+    diskcache = None
+
+# Optional semantic cache index
+try:
+    import numpy as np
+    import faiss
+except Exception:
+    np = None
+    faiss = None
+
 # OpenAI
-from openai import OpenAI
+from openai import (
+    APIConnectionError,
+    AsyncOpenAI,
+    DEFAULT_CONNECTION_LIMITS,
+    DefaultAsyncHttpxClient,
+    InternalServerError,
+    RateLimitError,
+    Timeout,
+)
+
+# httpx's HTTP/2 support is the optional h2 package (httpx[http2]); without
+# it, http2=True raises at client construction.
+try:
+    import h2
+except Exception:
+    h2 = None
 
 
 # =====================
 # App + Config
 # =====================
 
-app = FastAPI()
+class ORJSONResponse(JSONResponse):
+    # Local equivalent of fastapi.responses.ORJSONResponse, which newer
+    # FastAPI releases deprecate.
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+# Interactive docs are off unless explicitly enabled (not needed in production).
+ENABLE_DOCS = os.getenv("ENABLE_DOCS", "0") == "1"
+
+app = FastAPI(
+    default_response_class=ORJSONResponse,
+    docs_url="/docs" if ENABLE_DOCS else None,
+    redoc_url="/redoc" if ENABLE_DOCS else None,
+    openapi_url="/openapi.json" if ENABLE_DOCS else None,
+)
 
 MODEL = os.getenv("MODEL", "gpt-4.1")  # MOST POWERFUL API MODEL
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Ask for notes as a typed JSON tree (json_schema response format) and build
+# the documents from it, instead of streaming markdown and parsing lines.
+# Nothing is rendered until the whole response has arrived.
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "0") == "1"
 
 MAX_FILES = int(os.getenv("MAX_FILES", "10"))
 MAX_MB_PER_FILE = int(os.getenv("MAX_MB_PER_FILE", "25"))
 MAX_TOTAL_MB = int(os.getenv("MAX_TOTAL_MB", "80"))
 
+# Sources over MAX_PROMPT_TOKENS are condensed batch-by-batch before the final
+# call, repeating on the summaries until they fit. Uploads that would need
+# more than MAX_SUMMARY_BATCHES batches are refused; nothing is dropped.
+MAX_PROMPT_TOKENS = int(os.getenv("MAX_PROMPT_TOKENS", "100000"))
+MAX_SUMMARY_BATCHES = int(os.getenv("MAX_SUMMARY_BATCHES", "8"))
+
+# Extraction runs in worker processes by default: python-docx and the
+# python-pptx fallback hold the GIL. EXTRACT_EXECUTOR=thread trades that for
+# no pickling of upload bytes. With several uvicorn workers
+# (WEB_CONCURRENCY), cores are split between their pools.
+EXTRACT_EXECUTOR = os.getenv("EXTRACT_EXECUTOR", "process").strip().lower()
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+EXTRACT_WORKERS = int(os.getenv(
+    "EXTRACT_WORKERS", str(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY))
+))
+
 SHARED_SECRET = os.getenv("BACKEND_SHARED_SECRET", "").strip()
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Response caching only makes sense for deterministic calls, so it is opt-in
+# and forces temperature 0 when enabled.
+CACHE_LLM = os.getenv("CACHE_LLM", "0") == "1"
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", str(24 * 3600)))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "256"))
+REDIS_URL = os.getenv("REDIS_URL", "").strip()
+# On-disk store shared by the workers of one host; used when REDIS_URL is unset.
+CACHE_DIR = os.getenv("CACHE_DIR", "").strip()
+TEMPERATURE = 0.0 if CACHE_LLM else 0.1
+# Extracted text is deterministic per file, so it is cached by content digest
+# (same backend as above) and repeat uploads skip parsing entirely. On by
+# default only with a shared backend: the in-process fallback is bounded by
+# entry count, so whole texts there would push out cached notes.
+_SHARED_CACHE = bool(REDIS_URL and aioredis is not None) or bool(CACHE_DIR and diskcache is not None)
+EXTRACT_CACHE = os.getenv("EXTRACT_CACHE", "1" if _SHARED_CACHE else "0") == "1"
+EXTRACT_CACHE_TTL_SECONDS = int(os.getenv("EXTRACT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+# Paragraphs of at least this many characters that already appeared earlier
+# in the upload (shared cover pages, repeated slides) are sent only once.
+# Shorter ones are kept: a repeated "Summary" still marks where it stands.
+DEDUP_MIN_CHARS = int(os.getenv("DEDUP_MIN_CHARS", "40"))
+
+# Semantic cache: reuse notes for near-duplicate uploads (edited / re-exported decks).
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_THRESHOLD = float(os.getenv("SEMANTIC_THRESHOLD", "0.95"))
+SEMANTIC_MAX_ENTRIES = int(os.getenv("SEMANTIC_MAX_ENTRIES", "1000"))
+# A hit must also be within this fraction of the cached source's length, so
+# an upload that only starts like a cached one (same deck plus another) misses.
+SEMANTIC_LENGTH_TOLERANCE = float(os.getenv("SEMANTIC_LENGTH_TOLERANCE", "0.1"))
+# The index dimension comes from the first embedding, so any model works.
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+# Texts are embedded in chunks of this many tokens (well inside the 8191
+# input limit even where counts fall back to len // 4), then mean-pooled.
+EMBEDDING_CHUNK_TOKENS = int(os.getenv("EMBEDDING_CHUNK_TOKENS", "2000"))
+
+# One pooled client per worker (HTTP/2 when h2 is installed), so concurrent
+# chat and embedding requests reuse TLS connections instead of handshaking
+# each time.
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "120"))
+OPENAI_CONNECT_TIMEOUT_SECONDS = float(os.getenv("OPENAI_CONNECT_TIMEOUT_SECONDS", "5"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "50"))
+
+# Client-side pacing for chat and embedding calls, one limiter per model
+# since OpenAI budgets each model separately. The RPM/TPM budgets come from
+# the x-ratelimit-* headers of each response; OPENAI_RPM/OPENAI_TPM only seed
+# them before the first one (0 = unknown until then). Budgets are split
+# across WEB_CONCURRENCY workers. Retries happen here, not in the SDK, so a
+# 429 pauses every caller and the attempt count is OPENAI_MAX_RETRIES + 1.
+OPENAI_MAX_CONCURRENT = int(os.getenv("OPENAI_MAX_CONCURRENT", "16"))
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "0"))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "0"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+
+
+def _make_http_client():
+    # The SDK's own client class keeps its defaults (redirects, transport);
+    # only the pool size changes. Limits comes from the httpx the SDK uses.
+    limits = type(DEFAULT_CONNECTION_LIMITS)(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+    )
+    return DefaultAsyncHttpxClient(http2=h2 is not None, limits=limits)
+
+
+# The SDK sends its own timeout with every request, so it is set here rather
+# than on the http client.
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=_make_http_client(),
+    timeout=Timeout(OPENAI_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS),
+    max_retries=0,
+)
+
+
+class _Bucket:
+    """Per-minute budget that refills continuously; capacity 0 means unlimited."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.stamp = time.monotonic()
+
+    def wait_time(self, amount: float, now: float) -> float:
+        if self.capacity <= 0:
+            return 0.0
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.capacity / 60)
+        self.stamp = now
+        # A call larger than the whole budget waits for a full bucket, not forever.
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) * 60 / self.capacity)
+
+    def take(self, amount: float):
+        if self.capacity > 0:
+            self.level -= amount
+
+    def observe(self, limit: Optional[str], remaining: Optional[str]):
+        try:
+            if limit:
+                capacity = float(limit) / WEB_CONCURRENCY
+                if self.capacity <= 0:
+                    self.level = capacity
+                self.capacity = capacity
+            if remaining is not None and self.capacity > 0:
+                self.level = min(self.level, float(remaining))
+        except ValueError:
+            pass
+
+
+def _retry_after(headers) -> float:
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        return float(headers.get("retry-after", 1))
+    except ValueError:
+        return 1.0
+
+
+class RateLimiter:
+    """Paces OpenAI calls to stay under the RPM/TPM limits instead of
+    discovering them through 429s, in the spirit of the openai-cookbook
+    parallel processor. Callers queue on one lock in arrival order.
+    """
+
+    def __init__(self, max_concurrent: int, rpm: float, tpm: float):
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._lock = asyncio.Lock()
+        self._requests = _Bucket(rpm)
+        self._tokens = _Bucket(tpm)
+        self._paused_until = 0.0
+
+    async def _acquire(self, tokens: int):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                delay = max(
+                    self._paused_until - now,
+                    self._requests.wait_time(1, now),
+                    self._tokens.wait_time(tokens, now),
+                )
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self._requests.take(1)
+            self._tokens.take(tokens)
+
+    def _observe(self, headers):
+        self._requests.observe(headers.get("x-ratelimit-limit-requests"), headers.get("x-ratelimit-remaining-requests"))
+        self._tokens.observe(headers.get("x-ratelimit-limit-tokens"), headers.get("x-ratelimit-remaining-tokens"))
+
+    async def call(self, fn: Callable, *args, tokens: int = 0, **kwargs):
+        """Await fn (a client.*.with_raw_response method) and return the parsed result."""
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            backoff = 0.0
+            async with self._slots:
+                await self._acquire(tokens)
+                try:
+                    raw = await fn(*args, **kwargs)
+                except RateLimitError as exc:
+                    # Everyone waits out the server's Retry-After, not just this call.
+                    self._paused_until = max(self._paused_until, time.monotonic() + _retry_after(exc.response.headers))
+                    if attempt == OPENAI_MAX_RETRIES:
+                        raise
+                    continue
+                except (APIConnectionError, InternalServerError):
+                    if attempt == OPENAI_MAX_RETRIES:
+                        raise
+                    backoff = 0.5 * 2**attempt
+            if backoff:
+                # Transient failures only back off this call, outside its slot.
+                await asyncio.sleep(backoff)
+                continue
+            self._observe(raw.headers)
+            return raw.parse()
+
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+
+
+async def throttled_call(fn: Callable, *args, tokens: int = 0, **kwargs):
+    model = kwargs.get("model", "")
+    limiter = _rate_limiters.get(model)
+    if limiter is None:
+        limiter = _rate_limiters[model] = RateLimiter(
+            OPENAI_MAX_CONCURRENT, OPENAI_RPM / WEB_CONCURRENCY, OPENAI_TPM / WEB_CONCURRENCY
+        )
+    return await limiter.call(fn, *args, tokens=tokens, **kwargs)
 
 
 # =====================
@@ -62,21 +349,39 @@ def _require_secret(request: Request):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
 
+class _UnsafeToUnderscore(dict):
+    # str.translate consults __missing__ for any code point not listed, so
+    # one C-level pass covers non-ASCII too, with no encode/decode round trip.
+    def __missing__(self, key: int) -> str:
+        return "_"
+
+
+_SAFE_TABLE = _UnsafeToUnderscore({ord(c): ord(c) for c in string.ascii_letters + string.digits + "._-"})
+
+
 def _safe_filename(name: str) -> str:
-    return re.sub(r"[^a-zA-Z0-9._-]+", "_", name or "file")[:120]
+    return (name or "file")[:120].translate(_SAFE_TABLE)
 
 
-def _read_uploadfile(f: UploadFile) -> bytes:
-    data = f.file.read()
-    if len(data) > MAX_MB_PER_FILE * 1024 * 1024:
-        raise HTTPException(status_code=413, detail=f"{f.filename} too large")
-    return data
+async def _read_uploadfile(f: UploadFile, remaining_total: int) -> Tuple[bytes, str]:
+    """Return (data, content digest)."""
+    per_file = MAX_MB_PER_FILE * 1024 * 1024
+    limit = min(per_file, remaining_total)
 
+    def check(size: int):
+        if size > per_file:
+            raise HTTPException(status_code=413, detail=f"{f.filename} too large")
+        if size > remaining_total:
+            raise HTTPException(status_code=413, detail="Total upload too large")
 
-def _check_total_size(files: List[Tuple[str, bytes]]):
-    total = sum(len(b) for _, b in files)
-    if total > MAX_TOTAL_MB * 1024 * 1024:
-        raise HTTPException(status_code=413, detail="Total upload too large")
+    # The multipart parser already knows the size, so oversized files are
+    # refused unread. Otherwise a single bounded read lands the upload in
+    # one bytes object instead of accumulating chunks and copying them.
+    if f.size is not None:
+        check(f.size)
+    data = await f.read(limit + 1)
+    check(len(data))
+    return data, hashlib.blake2b(data, digest_size=16).hexdigest()
 
 
 # =====================
@@ -84,22 +389,116 @@ def _check_total_size(files: List[Tuple[str, bytes]]):
 # =====================
 
 def extract_pdf(data: bytes) -> str:
-    if PdfReader is None:
-        raise HTTPException(status_code=500, detail="pypdf not installed")
-    reader = PdfReader(io.BytesIO(data))
-    return "\n\n".join(
-        (page.extract_text() or "").strip()
-        for page in reader.pages
-        if page.extract_text()
-    )
+    if pymupdf is None:
+        raise HTTPException(status_code=500, detail="pymupdf not installed")
+    # MuPDF parses and maps glyphs in native code.
+    flags = pymupdf.TEXTFLAGS_TEXT | pymupdf.TEXT_DEHYPHENATE
+    with pymupdf.open(stream=data, filetype="pdf") as doc:
+        pages = (page.get_text("text", flags=flags).strip() for page in doc)
+        return "\n\n".join(p for p in pages if p)
 
 
 def extract_docx(data: bytes) -> str:
     doc = Document(io.BytesIO(data))
-    return "\n".join(p.text.strip() for p in doc.paragraphs if p.text.strip())
+    # Blank-line separated like PDF pages and slides, so dedup_paragraphs
+    # sees each paragraph on its own.
+    return "\n\n".join(p.text.strip() for p in doc.paragraphs if p.text.strip())
+
+
+_OOXML_NS = {
+    "a": "http://schemas.openxmlformats.org/drawingml/2006/main",
+    "p": "http://schemas.openxmlformats.org/presentationml/2006/main",
+    "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+}
+_A_P = f"{{{_OOXML_NS['a']}}}p"
+_A_T = f"{{{_OOXML_NS['a']}}}t"
+_A_R = f"{{{_OOXML_NS['a']}}}r"
+_A_FLD = f"{{{_OOXML_NS['a']}}}fld"
+_A_BR = f"{{{_OOXML_NS['a']}}}br"
+_P_SP = f"{{{_OOXML_NS['p']}}}sp"
+_P_SLD_ID = f"{{{_OOXML_NS['p']}}}sldId"
+_R_ID = f"{{{_OOXML_NS['r']}}}id"
+_NOTES_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/notesSlide"
+
+
+def _ooxml_rels(zf: zipfile.ZipFile, part: str) -> dict:
+    """Map rId -> (type, part name) for one OOXML part."""
+    base, name = posixpath.split(part)
+    rels_part = posixpath.join(base, "_rels", name + ".rels")
+    if rels_part not in zf.NameToInfo:
+        return {}
+    rels = {}
+    for rel in etree.fromstring(zf.read(rels_part)):
+        target = rel.get("Target", "")
+        if target.startswith("/"):
+            target = target[1:]
+        else:
+            target = posixpath.normpath(posixpath.join(base, target))
+        rels[rel.get("Id")] = (rel.get("Type"), target)
+    return rels
 
 
-def extract_pptx(data: bytes) -> str:
+def _drawingml_paragraphs(elements) -> List[str]:
+    out = []
+    for p in elements:
+        # Runs, fields and line breaks in document order; an a:br is a line
+        # break within the paragraph (python-pptx reports it as "\v").
+        pieces = []
+        for child in p:
+            if child.tag == _A_BR:
+                pieces.append("\n")
+            elif child.tag == _A_R or child.tag == _A_FLD:
+                t = child.find(_A_T)
+                if t is not None and t.text:
+                    pieces.append(t.text)
+        text = "".join(pieces).strip()
+        if text:
+            out.append(text)
+    return out
+
+
+def _pptx_slide_text(source) -> List[str]:
+    out = []
+    for _, p in etree.iterparse(source, tag=_A_P):
+        out.extend(_drawingml_paragraphs([p]))
+        p.clear()
+    return out
+
+
+def _pptx_notes_text(source) -> str:
+    for _, sp in etree.iterparse(source, tag=_P_SP):
+        ph = sp.find("p:nvSpPr/p:nvPr/p:ph", _OOXML_NS)
+        if ph is not None and ph.get("type") == "body":
+            return "\n".join(_drawingml_paragraphs(sp.iter(_A_P)))
+        sp.clear()
+    return ""
+
+
+def _extract_pptx_xml(data: bytes) -> str:
+    # Reads slide XML straight out of the package instead of building the
+    # python-pptx object model; only text runs are needed.
+    zf = zipfile.ZipFile(io.BytesIO(data))
+    rels = _ooxml_rels(zf, "ppt/presentation.xml")
+    presentation = etree.fromstring(zf.read("ppt/presentation.xml"))
+    slide_parts = [rels[s.get(_R_ID)][1] for s in presentation.iter(_P_SLD_ID)]
+
+    out = []
+    for i, part in enumerate(slide_parts, start=1):
+        with zf.open(part) as f:
+            parts = _pptx_slide_text(f)
+        for rel_type, target in _ooxml_rels(zf, part).values():
+            if rel_type == _NOTES_REL and target in zf.NameToInfo:
+                with zf.open(target) as f:
+                    notes = _pptx_notes_text(f)
+                if notes:
+                    parts.append(f"(Notes) {notes}")
+                break
+        if parts:
+            out.append(f"Slide {i}:\n" + "\n".join(parts))
+    return "\n\n".join(out)
+
+
+def _extract_pptx_object_model(data: bytes) -> str:
     if Presentation is None:
         raise HTTPException(status_code=500, detail="python-pptx not installed")
     prs = Presentation(io.BytesIO(data))
@@ -108,9 +507,9 @@ def extract_pptx(data: bytes) -> str:
         parts = []
         for shape in slide.shapes:
             if hasattr(shape, "text") and shape.text.strip():
-                parts.append(shape.text.strip())
+                parts.append(shape.text.strip().replace("\v", "\n"))
         try:
-            notes = slide.notes_slide.notes_text_frame.text.strip()
+            notes = slide.notes_slide.notes_text_frame.text.strip().replace("\v", "\n")
             if notes:
                 parts.append(f"(Notes) {notes}")
         except Exception:
@@ -120,6 +519,13 @@ def extract_pptx(data: bytes) -> str:
     return "\n\n".join(out)
 
 
+def extract_pptx(data: bytes) -> str:
+    try:
+        return _extract_pptx_xml(data)
+    except (zipfile.BadZipFile, KeyError, etree.XMLSyntaxError):
+        return _extract_pptx_object_model(data)
+
+
 def extract_text(filename: str, data: bytes) -> str:
     fn = filename.lower()
     if fn.endswith(".pdf"):
@@ -133,150 +539,1126 @@ def extract_text(filename: str, data: bytes) -> str:
     raise HTTPException(status_code=400, detail=f"Unsupported file type: {filename}")
 
 
+def _make_extract_pool():
+    if EXTRACT_EXECUTOR == "thread":
+        return ThreadPoolExecutor(max_workers=EXTRACT_WORKERS, thread_name_prefix="extract")
+    # Children start on demand, mid-request, when the event loop's helper
+    # threads are already running; forking then is unsafe, so they are
+    # started fresh instead.
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    return ProcessPoolExecutor(max_workers=EXTRACT_WORKERS, mp_context=context)
+
+
+extract_pool = _make_extract_pool()
+
+
+def _replace_extract_pool(broken):
+    global extract_pool
+    # Concurrent requests all see the same breakage; only the first replaces it.
+    if extract_pool is broken:
+        extract_pool = _make_extract_pool()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _extract_job(filename: str, data: bytes) -> Tuple[Optional[str], Optional[Tuple[int, str]]]:
+    # HTTPException cannot be unpickled in the parent process, so errors
+    # travel back as (status_code, detail) and are re-raised there.
+    try:
+        return extract_text(filename, data), None
+    except HTTPException as exc:
+        return None, (exc.status_code, exc.detail)
+
+
+def _text_key(filename: str, digest: str) -> str:
+    # The extension picks the extractor, so it is part of the key.
+    return f"text:{posixpath.splitext(filename.lower())[1]}:{digest}"
+
+
+async def _run_extract_jobs(blobs: List[Tuple[str, bytes]]) -> list:
+    loop = asyncio.get_running_loop()
+    for _ in range(2):
+        pool = extract_pool
+        try:
+            return await asyncio.gather(*(loop.run_in_executor(pool, _extract_job, *blob) for blob in blobs))
+        except BrokenProcessPool:
+            # A child died (OOM kill, extractor crash), which breaks the whole
+            # pool. Swap in a fresh one and retry once, so a crash costs at
+            # most the request that caused it.
+            _replace_extract_pool(pool)
+    raise HTTPException(status_code=422, detail="Text extraction crashed on this upload")
+
+
+async def extract_all(file_blobs: List[Tuple[str, bytes]], digests: List[str]) -> List[str]:
+    keys = [_text_key(name, digest) for (name, _), digest in zip(file_blobs, digests)]
+    if EXTRACT_CACHE:
+        texts = await asyncio.gather(*(_cache_get(key, "text_") for key in keys))
+    else:
+        texts = [None] * len(file_blobs)
+
+    misses = [i for i, text in enumerate(texts) if text is None]
+    results = await _run_extract_jobs([file_blobs[i] for i in misses])
+    for i, (text, error) in zip(misses, results):
+        if error:
+            raise HTTPException(status_code=error[0], detail=error[1])
+        texts[i] = text
+    if EXTRACT_CACHE:
+        await asyncio.gather(*(_cache_set(keys[i], texts[i], EXTRACT_CACHE_TTL_SECONDS) for i in misses))
+    return texts
+
+
+# The "Slide N:" line extract_pptx puts first; a slide repeated at another
+# position is still the same slide.
+_SLIDE_HEADER_RE = re.compile(r"\ASlide \d+:\n")
+
+
+def dedup_paragraphs(texts: List[str]) -> List[str]:
+    """Drop repeated paragraphs across all texts, keeping first occurrences in order."""
+    if DEDUP_MIN_CHARS <= 0:
+        return texts
+    seen = set()
+    out = []
+    for text in texts:
+        kept = []
+        for para in text.split("\n\n"):
+            body = _SLIDE_HEADER_RE.sub("", para, count=1)
+            if len(body) >= DEDUP_MIN_CHARS:
+                # Compare modulo whitespace, which differs between extractors.
+                key = " ".join(body.split())
+                if key in seen:
+                    continue
+                seen.add(key)
+            kept.append(para)
+        out.append("\n\n".join(kept))
+    return out
+
+
 # =====================
-# AI — FINAL PROMPT (GPT-4.1)
+# Response Cache
 # =====================
 
-def call_ai_make_notes(source_text: str) -> str:
-    if not OPENAI_API_KEY:
-        raise HTTPException(status_code=500, detail="OPENAI_API_KEY missing")
+class CacheBackend(ABC):
+    @abstractmethod
+    async def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: int):
+        ...
+
+    @abstractmethod
+    async def incr(self, field: str, amount: int = 1):
+        ...
+
+    @abstractmethod
+    async def counters(self) -> dict:
+        ...
 
-    system = (
-        "You are a senior pharmacy educator creating exam-critical study material. "
-        "You MUST strictly use ONLY the provided source material. "
-        "You are NOT allowed to add external knowledge, assumptions, or general facts. "
-        "If something is not explicitly stated in the source, you MUST write exactly: "
-        "'Not covered in these slides'. "
-        "Output must be clean, strict Markdown suitable for DOCX and PDF conversion."
-    )
 
-    user = (
-        "You MUST create TWO SEPARATE DOCUMENTS in ONE response.\n\n"
-
-        "# DOCUMENT 1: STUDY NOTES (PHARMACY)\n\n"
-
-        "Audience:\n"
-        "- A pharmacy student studying this topic for the FIRST TIME.\n\n"
-
-        "MANDATORY RULES:\n"
-        "- Do NOT remove or omit anything related to the learning objectives.\n"
-        "- Organize core content BY learning objective.\n"
-        "- Be concise, consolidated, and accurate.\n"
-        "- Do NOT invent or infer beyond the source.\n"
-        "- Any missing detail must be written as: 'Not covered in these slides'.\n\n"
-
-        "MANDATORY STRUCTURE:\n"
-        "## Title\n"
-        "## Learning Objectives\n"
-        "## Big Picture Overview (5–6 bullets explaining how concepts connect)\n"
-        "## Core Notes (grouped explicitly by learning objective)\n"
-        "## Diagrams & Flowcharts\n"
-        "   - You MUST include text-based diagrams or flowcharts WHERE THEY HELP UNDERSTANDING.\n"
-        "   - Especially for mechanisms, pathways, comparisons, or cause–effect relationships.\n"
-        "   - Use ASCII arrows, steps, or simple box flows.\n"
-        "## Additional Information\n"
-        "   - ONLY content not essential for meeting learning objectives.\n"
-        "## Key Terms (clear, pharmacy-relevant definitions)\n\n"
-
-        "# DOCUMENT 2: RAPID REVIEW (PHARMACY EXAM)\n\n"
-
-        "Audience:\n"
-        "- A student revising immediately before an exam.\n\n"
-
-        "MANDATORY RULES:\n"
-        "- Extremely concise.\n"
-        "- Bullet points ONLY.\n"
-        "- No explanations unless absolutely essential.\n"
-        "- Focus on high-yield exam recall.\n\n"
-
-        "MANDATORY STRUCTURE:\n"
-        "## High-Yield Facts\n"
-        "## High-Yield Drug Points (MOA, indication, cautions, interactions IF PRESENT)\n"
-        "## Interactions & Monitoring\n"
-        "## Common Exam Traps / Confusions\n"
-        "## Exam-Style Questions\n\n"
-
-        "================================\n"
-        "SOURCE MATERIAL (USE ONLY THIS)\n"
-        "================================\n"
-        f"{source_text}"
+class MemoryCache(CacheBackend):
+    """In-process LRU fallback used when Redis is not configured."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._counters: dict = {}
+
+    async def get(self, key: str) -> Optional[str]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: int):
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    async def incr(self, field: str, amount: int = 1):
+        self._counters[field] = self._counters.get(field, 0) + amount
+
+    async def counters(self) -> dict:
+        return dict(self._counters)
+
+
+class RedisCache(CacheBackend):
+    """Shared by all uvicorn workers, including the stats counters."""
+
+    STATS_KEY = "notes:stats"
+
+    def __init__(self, url: str):
+        self._redis = aioredis.Redis.from_url(url, decode_responses=True)
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._redis.get(key)
+
+    async def set(self, key: str, value: str, ttl: int):
+        await self._redis.setex(key, ttl, value)
+
+    async def incr(self, field: str, amount: int = 1):
+        await self._redis.hincrby(self.STATS_KEY, field, amount)
+
+    async def counters(self) -> dict:
+        return {k: int(v) for k, v in (await self._redis.hgetall(self.STATS_KEY)).items()}
+
+
+class DiskCache(CacheBackend):
+    """diskcache is synchronous (SQLite), so calls run in worker threads."""
+
+    STATS_PREFIX = "stats:"
+
+    def __init__(self, directory: str):
+        self._cache = diskcache.Cache(directory)
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._cache.get, key)
+
+    async def set(self, key: str, value: str, ttl: int):
+        await asyncio.to_thread(self._cache.set, key, value, expire=ttl)
+
+    async def incr(self, field: str, amount: int = 1):
+        await asyncio.to_thread(self._cache.incr, self.STATS_PREFIX + field, amount)
+
+    async def counters(self) -> dict:
+        def read():
+            return {field: self._cache.get(self.STATS_PREFIX + field, 0) for field in STAT_FIELDS}
+        return await asyncio.to_thread(read)
+
+
+def _make_cache_backend() -> CacheBackend:
+    if REDIS_URL and aioredis is not None:
+        return RedisCache(REDIS_URL)
+    if CACHE_DIR and diskcache is not None:
+        return DiskCache(CACHE_DIR)
+    return MemoryCache(CACHE_MAX_ENTRIES)
+
+
+cache_backend = _make_cache_backend()
+STAT_FIELDS = (
+    "hits",
+    "misses",
+    "semantic_hits",
+    "semantic_misses",
+    "text_hits",
+    "text_misses",
+    # Provider-side automatic prefix caching, as reported in response usage.
+    "prompt_tokens",
+    "cached_prompt_tokens",
+)
+
+
+async def _stat(field: str, amount: int = 1):
+    try:
+        await cache_backend.incr(field, amount)
+    except Exception:
+        pass
+
+
+def _prompt_hasher(prefix: Tuple[dict, ...], schema: Optional[dict] = None) -> "hashlib._Hash":
+    # Hashed once at import; each request only copies the state and feeds
+    # its source text instead of re-serialising the whole prompt.
+    seed = json.dumps({"model": MODEL, "messages": prefix, "schema": schema}, sort_keys=True)
+    return hashlib.sha256(seed.encode() + b"\0")
+
+
+def _cache_key(hasher: "hashlib._Hash", source_text: str) -> str:
+    h = hasher.copy()
+    h.update(source_text.encode())
+    return "notes:" + h.hexdigest()
+
+
+async def _cache_get(key: str, stat: str = "") -> Optional[str]:
+    # A cache outage must never fail a request; treat it as a miss.
+    try:
+        value = await cache_backend.get(key)
+    except Exception:
+        value = None
+    await _stat(stat + ("hits" if value is not None else "misses"))
+    return value
+
+
+async def _record_usage(usage):
+    await _stat("prompt_tokens", usage.prompt_tokens or 0)
+    details = getattr(usage, "prompt_tokens_details", None)
+    await _stat("cached_prompt_tokens", getattr(details, "cached_tokens", 0) or 0)
+
+
+async def _cache_set(key: str, value: str, ttl: int = CACHE_TTL_SECONDS):
+    try:
+        await cache_backend.set(key, value, ttl)
+    except Exception:
+        pass
+
+
+class SemanticCache:
+    """Inner-product FAISS index over normalized embeddings (= cosine similarity).
+
+    Each entry keeps the length of its source text next to the notes. The
+    index is created on the first vector seen, sized to the model's output.
+    With Redis configured, entries are appended to a shared list and every
+    worker replays new rows into its local index before searching.
+    """
+
+    # Per model: entries from another model have another dimension.
+    ENTRIES_KEY = f"semantic:{EMBEDDING_MODEL}:entries"
+    CANDIDATES = 4
+
+    def __init__(self, max_entries: int, redis_url: str = ""):
+        self.index = None
+        self.notes: List[str] = []
+        self.lengths: List[int] = []
+        self.max_entries = max_entries
+        self._redis = (
+            aioredis.Redis.from_url(redis_url) if redis_url and aioredis is not None else None
+        )
+        self._sync_lock = asyncio.Lock()
+
+    @property
+    def size(self) -> int:
+        return self.index.ntotal if self.index is not None else 0
+
+    def _index_for(self, vec):
+        if self.index is None:
+            self.index = faiss.IndexFlatIP(vec.shape[1])
+        return self.index
+
+    async def _sync(self, dim: int):
+        if self._redis is None:
+            return
+        vec_bytes = dim * 4
+        # Concurrent requests must not replay the same rows twice.
+        async with self._sync_lock:
+            for entry in await self._redis.lrange(self.ENTRIES_KEY, self.size, -1):
+                vec = np.frombuffer(entry[:vec_bytes], dtype="float32").reshape(1, dim)
+                self._index_for(vec).add(vec)
+                self.lengths.append(int.from_bytes(entry[vec_bytes:vec_bytes + 4], "little"))
+                self.notes.append(entry[vec_bytes + 4:].decode("utf-8"))
+
+    async def search(self, vec, length: int) -> Tuple[float, Optional[str]]:
+        """Best (score, notes) among the nearest entries of a similar length."""
+        await self._sync(vec.shape[1])
+        if self.size == 0:
+            return 0.0, None
+        scores, ids = self.index.search(vec, min(self.CANDIDATES, self.size))
+        for score, i in zip(scores[0], ids[0]):
+            if abs(self.lengths[i] - length) <= SEMANTIC_LENGTH_TOLERANCE * max(length, self.lengths[i]):
+                return float(score), self.notes[i]
+        return 0.0, None
+
+    async def add(self, vec, length: int, notes_md: str):
+        if self._redis is not None:
+            if await self._redis.llen(self.ENTRIES_KEY) < self.max_entries:
+                entry = vec.tobytes() + length.to_bytes(4, "little") + notes_md.encode("utf-8")
+                await self._redis.rpush(self.ENTRIES_KEY, entry)
+            return
+        if self.size >= self.max_entries:
+            return
+        self._index_for(vec).add(vec)
+        self.lengths.append(length)
+        self.notes.append(notes_md)
+
+
+semantic_cache = (
+    SemanticCache(SEMANTIC_MAX_ENTRIES, REDIS_URL)
+    if SEMANTIC_CACHE and faiss is not None
+    else None
+)
+
+
+async def _embed(text: str):
+    # The whole text counts: chunks are embedded in one request and their
+    # vectors averaged, weighted by chunk length.
+    chunks = _split_tokens(text, EMBEDDING_CHUNK_TOKENS) or [""]
+    response = await throttled_call(
+        client.embeddings.with_raw_response.create,
+        model=EMBEDDING_MODEL,
+        input=chunks,
+        tokens=len(text) // 4,
     )
+    vecs = np.asarray([item.embedding for item in sorted(response.data, key=lambda d: d.index)], dtype="float32")
+    weights = np.asarray([max(1, len(chunk)) for chunk in chunks], dtype="float32")
+    vec = (weights @ vecs / weights.sum()).reshape(1, -1)
+    faiss.normalize_L2(vec)
+    return vec
+
+
+async def semantic_lookup(source_text: str):
+    """Return (cached_notes, embedding); either may be None."""
+    if semantic_cache is None:
+        return None, None
+    try:
+        vec = await _embed(source_text)
+        score, notes_md = await semantic_cache.search(vec, len(source_text))
+    except Exception:
+        return None, None
+    if notes_md is not None and score >= SEMANTIC_THRESHOLD:
+        await _stat("semantic_hits")
+        return notes_md, vec
+    await _stat("semantic_misses")
+    return None, vec
+
+
+async def semantic_store(vec, source_text: str, notes_md: str):
+    try:
+        await semantic_cache.add(vec, len(source_text), notes_md)
+    except Exception:
+        pass
+
+
+@app.get("/cache/stats")
+async def get_cache_stats(request: Request):
+    _require_secret(request)
+    try:
+        counters = await cache_backend.counters()
+    except Exception:
+        counters = {}
+    return {
+        "enabled": CACHE_LLM,
+        "backend": type(cache_backend).__name__,
+        "semantic_enabled": semantic_cache is not None,
+        "semantic_entries": semantic_cache.size if semantic_cache else 0,
+        **{field: counters.get(field, 0) for field in STAT_FIELDS},
+    }
+
 
-    response = client.chat.completions.create(
+# =====================
+# AI — FINAL PROMPT (GPT-4.1)
+# =====================
+
+def _replay(md: str, on_block: Optional[Callable[[tuple], None]]):
+    if on_block is None:
+        return
+    for block in parse_markdown(md):
+        on_block(block)
+
+
+SYSTEM_PROMPT = (
+    "You are a senior pharmacy educator creating exam-critical study material. "
+    "You MUST strictly use ONLY the provided source material. "
+    "You are NOT allowed to add external knowledge, assumptions, or general facts. "
+    "If something is not explicitly stated in the source, you MUST write exactly: "
+    "'Not covered in these slides'. "
+    "Output must be clean, strict Markdown suitable for DOCX and PDF conversion."
+)
+
+SOURCE_HEADER = (
+    "================================\n"
+    "SOURCE MATERIAL (USE ONLY THIS)\n"
+    "================================\n"
+)
+
+NOTES_INSTRUCTIONS = (
+    "You MUST create TWO SEPARATE DOCUMENTS in ONE response.\n\n"
+
+    "# DOCUMENT 1: STUDY NOTES (PHARMACY)\n\n"
+
+    "Audience:\n"
+    "- A pharmacy student studying this topic for the FIRST TIME.\n\n"
+
+    "MANDATORY RULES:\n"
+    "- Do NOT remove or omit anything related to the learning objectives.\n"
+    "- Organize core content BY learning objective.\n"
+    "- Be concise, consolidated, and accurate.\n"
+    "- Do NOT invent or infer beyond the source.\n"
+    "- Any missing detail must be written as: 'Not covered in these slides'.\n\n"
+
+    "MANDATORY STRUCTURE:\n"
+    "## Title\n"
+    "## Learning Objectives\n"
+    "## Big Picture Overview (5–6 bullets explaining how concepts connect)\n"
+    "## Core Notes (grouped explicitly by learning objective)\n"
+    "## Diagrams & Flowcharts\n"
+    "   - You MUST include text-based diagrams or flowcharts WHERE THEY HELP UNDERSTANDING.\n"
+    "   - Especially for mechanisms, pathways, comparisons, or cause–effect relationships.\n"
+    "   - Use ASCII arrows, steps, or simple box flows.\n"
+    "## Additional Information\n"
+    "   - ONLY content not essential for meeting learning objectives.\n"
+    "## Key Terms (clear, pharmacy-relevant definitions)\n\n"
+
+    "# DOCUMENT 2: RAPID REVIEW (PHARMACY EXAM)\n\n"
+
+    "Audience:\n"
+    "- A student revising immediately before an exam.\n\n"
+
+    "MANDATORY RULES:\n"
+    "- Extremely concise.\n"
+    "- Bullet points ONLY.\n"
+    "- No explanations unless absolutely essential.\n"
+    "- Focus on high-yield exam recall.\n\n"
+
+    "MANDATORY STRUCTURE:\n"
+    "## High-Yield Facts\n"
+    "## High-Yield Drug Points (MOA, indication, cautions, interactions IF PRESENT)\n"
+    "## Interactions & Monitoring\n"
+    "## Common Exam Traps / Confusions\n"
+    "## Exam-Style Questions\n\n"
+) + SOURCE_HEADER
+
+SUMMARY_INSTRUCTIONS = (
+    "The source material below is one part of a lecture upload that is too long "
+    "to process in one go. Condense it for later note-making.\n\n"
+    "MANDATORY RULES:\n"
+    "- Preserve EVERY learning objective exactly as written.\n"
+    "- Preserve all definitions, mechanisms, drug details (MOA, indications, cautions, "
+    "interactions, monitoring) and numeric values.\n"
+    "- Remove only repetition, filler and formatting noise.\n"
+    "- Keep the '=== File: ... ===' markers.\n"
+    "- Do NOT add anything that is not in the source.\n\n"
+) + SOURCE_HEADER
+
+# The static head of every request, built once so each call sends a
+# byte-identical prefix; only the trailing source message varies.
+_NOTES_PREFIX = (
+    {"role": "system", "content": SYSTEM_PROMPT},
+    {"role": "user", "content": NOTES_INSTRUCTIONS},
+)
+_SUMMARY_PREFIX = (
+    {"role": "system", "content": SYSTEM_PROMPT},
+    {"role": "user", "content": SUMMARY_INSTRUCTIONS},
+)
+
+
+class NoteItem(BaseModel):
+    kind: Literal["paragraph", "bullet", "numbered"]
+    text: str
+
+
+class NoteSection(BaseModel):
+    heading: str
+    level: Literal[1, 2, 3]
+    items: List[NoteItem]
+
+
+class NotesDoc(BaseModel):
+    """Response schema in STRUCTURED_OUTPUT mode; levels follow the #/##/### of the prompt."""
+
+    sections: List[NoteSection]
+
+
+def _doc_blocks(doc: NotesDoc) -> Iterator[tuple]:
+    """Yield the same block tuples parse_markdown produces."""
+    for section in doc.sections:
+        heading = " ".join(section.heading.split())
+        if heading:
+            yield ("heading", section.level, heading)
+        # Numbering restarts with each run of numbered items, as in markdown.
+        number = 0
+        for item in section.items:
+            if item.kind != "numbered":
+                number = 0
+            if item.kind == "paragraph":
+                # Multi-line paragraphs are diagrams or flows; keep their rows.
+                for row in item.text.splitlines():
+                    if row.strip():
+                        yield ("para", row.strip())
+                continue
+            text = " ".join(item.text.split())
+            if not text:
+                continue
+            if item.kind == "numbered":
+                number += 1
+                yield ("num", str(number), text)
+            else:
+                yield ("bullet", text)
+
+
+def _blocks_markdown(blocks: List[tuple]) -> str:
+    # Markdown is what the caches store and replay, whatever mode produced it.
+    lines = []
+    for block in blocks:
+        kind = block[0]
+        if kind == "heading":
+            lines.append(f"{'#' * block[1]} {block[2]}")
+        elif kind == "bullet":
+            lines.append(f"- {block[1]}")
+        elif kind == "num":
+            lines.append(f"{block[1]}. {block[2]}")
+        elif block[1][0] in "#-*\\" or block[1][0].isdigit():
+            # Escaped so a row like "- x" or "1. x" replays as a paragraph.
+            lines.append("\\" + block[1])
+        else:
+            lines.append(block[1])
+    return "\n".join(lines)
+
+
+_NOTES_HASHER = _prompt_hasher(_NOTES_PREFIX, NotesDoc.model_json_schema() if STRUCTURED_OUTPUT else None)
+
+
+@functools.lru_cache(maxsize=1)
+def _token_encoding():
+    # encoding_for_model downloads the BPE file on first use; without it we
+    # fall back to estimating.
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(MODEL)
+    except Exception:
+        return None
+
+
+def count_tokens(text: str) -> int:
+    enc = _token_encoding()
+    if enc is None:
+        return len(text) // 4
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def _split_tokens(text: str, budget: int) -> List[str]:
+    enc = _token_encoding()
+    if enc is None:
+        step = budget * 4
+        return [text[i:i + step] for i in range(0, len(text), step)]
+    tokens = enc.encode(text, disallowed_special=())
+    return [enc.decode(tokens[i:i + budget]) for i in range(0, len(tokens), budget)]
+
+
+def _batch_blocks(blocks: List[str], budget: int) -> List[str]:
+    batches, current, used = [], [], 0
+    for block in blocks:
+        n = count_tokens(block)
+        pieces = _split_tokens(block, budget) if n > budget else [block]
+        for piece in pieces:
+            if len(pieces) > 1:
+                n = count_tokens(piece)
+            if current and used + n > budget:
+                batches.append("\n\n".join(current))
+                current, used = [], 0
+            current.append(piece)
+            used += n
+    if current:
+        batches.append("\n\n".join(current))
+    return batches
+
+
+def _request_tokens(messages: List[dict]) -> int:
+    # What OpenAI's limiter charges up front: roughly 4 characters per token.
+    return sum(len(m["content"]) for m in messages) // 4
+
+
+async def _summarize_batch(batch: str) -> str:
+    messages = [*_SUMMARY_PREFIX, {"role": "user", "content": batch}]
+    response = await throttled_call(
+        client.chat.completions.with_raw_response.create,
         model=MODEL,
-        messages=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
-        ],
-        temperature=0.1,
+        messages=messages,
+        temperature=TEMPERATURE,
+        tokens=_request_tokens(messages),
     )
+    if response.usage:
+        await _record_usage(response.usage)
+    return (response.choices[0].message.content or "").strip()
+
+
+async def fit_source_to_budget(blocks: List[str]) -> str:
+    """Join extracted file blocks, condensing them first if they exceed MAX_PROMPT_TOKENS."""
+    source_text = "\n\n".join(blocks)
+    if not OPENAI_API_KEY:
+        return source_text
+    if await asyncio.to_thread(count_tokens, source_text) <= MAX_PROMPT_TOKENS:
+        return source_text
+
+    batches = await asyncio.to_thread(_batch_blocks, blocks, MAX_PROMPT_TOKENS)
+    if len(batches) > MAX_SUMMARY_BATCHES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Upload too large to condense: {len(batches)} batches, limit is {MAX_SUMMARY_BATCHES}",
+        )
+    size = None
+    while True:
+        summaries = await asyncio.gather(*(_summarize_batch(batch) for batch in batches))
+        summaries = [s for s in summaries if s]
+        source_text = "\n\n".join(summaries)
+        n = await asyncio.to_thread(count_tokens, source_text)
+        if n <= MAX_PROMPT_TOKENS:
+            return source_text
+        # Still over budget: condense the summaries themselves, as long as
+        # each round actually shrinks them.
+        if size is not None and n >= size:
+            raise HTTPException(status_code=413, detail="Upload too large to condense within the prompt budget")
+        size = n
+        batches = await asyncio.to_thread(_batch_blocks, summaries, MAX_PROMPT_TOKENS)
+
+
+# Completions currently being generated, by cache key. A request whose
+# prompt is already in flight waits for that completion instead of paying
+# for its own.
+_inflight: dict = {}
+
+
+async def call_ai_make_notes(source_text: str, on_block: Optional[Callable[[tuple], None]] = None) -> str:
+    """Return the notes markdown, passing each parsed block to on_block as
+    soon as its line has been generated (or replayed from cache).
+    """
+    if not OPENAI_API_KEY:
+        raise HTTPException(status_code=500, detail="OPENAI_API_KEY missing")
+
+    key = _cache_key(_NOTES_HASHER, source_text)
+    if CACHE_LLM:
+        cached = await _cache_get(key)
+        if cached is not None:
+            _replay(cached, on_block)
+            return cached
 
-    content = response.choices[0].message.content.strip()
+    while (pending := _inflight.get(key)) is not None:
+        try:
+            content = await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            if not pending.cancelled():
+                raise
+            # The request generating it went away; try again ourselves.
+            continue
+        _replay(content, on_block)
+        return content
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        content = await _generate_notes(key, source_text, on_block)
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except BaseException as exc:
+        future.set_exception(exc)
+        future.exception()  # waiters are optional; don't log it as unretrieved
+        raise
+    else:
+        future.set_result(content)
+    finally:
+        del _inflight[key]
+    return content
+
+
+async def _generate_notes(key: str, source_text: str, on_block: Optional[Callable[[tuple], None]]) -> str:
+    similar, vec = await semantic_lookup(source_text)
+    if similar is not None:
+        _replay(similar, on_block)
+        return similar
+
+    messages = [*_NOTES_PREFIX, {"role": "user", "content": source_text}]
+    if STRUCTURED_OUTPUT:
+        content = await _structured_notes(messages, on_block)
+    else:
+        content = await _stream_notes(messages, on_block)
     if not content:
         raise HTTPException(status_code=500, detail="AI returned empty content")
+    if CACHE_LLM:
+        await _cache_set(key, content)
+    if vec is not None:
+        await semantic_store(vec, source_text, content)
     return content
 
 
+async def _structured_notes(messages: List[dict], on_block: Optional[Callable[[tuple], None]]) -> str:
+    completion = await throttled_call(
+        client.chat.completions.with_raw_response.parse,
+        model=MODEL,
+        messages=messages,
+        temperature=TEMPERATURE,
+        tokens=_request_tokens(messages),
+        response_format=NotesDoc,
+    )
+    if completion.usage:
+        await _record_usage(completion.usage)
+    message = completion.choices[0].message
+    if message.parsed is None:
+        raise HTTPException(status_code=500, detail=message.refusal or "AI returned empty content")
+    blocks = list(_doc_blocks(message.parsed))
+    if on_block:
+        for block in blocks:
+            on_block(block)
+    return _blocks_markdown(blocks)
+
+
+async def _stream_notes(messages: List[dict], on_block: Optional[Callable[[tuple], None]]) -> str:
+    stream = await throttled_call(
+        client.chat.completions.with_raw_response.create,
+        model=MODEL,
+        messages=messages,
+        temperature=TEMPERATURE,
+        tokens=_request_tokens(messages),
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+
+    streamer = MarkdownStreamer(on_block) if on_block else None
+    parts = []
+    async for chunk in stream:
+        if chunk.usage:
+            await _record_usage(chunk.usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            if streamer:
+                streamer.feed(delta)
+    if streamer:
+        streamer.close()
+    return "".join(parts).strip()
+
+
 # =====================
 # Output Builders
 # =====================
 
-def markdown_to_docx(md: str) -> bytes:
-    doc = Document()
-    for line in md.splitlines():
-        if not line.strip():
-            continue
-        if line.startswith("### "):
-            doc.add_heading(line[4:], level=3)
-        elif line.startswith("## "):
-            doc.add_heading(line[3:], level=2)
-        elif line.startswith("# "):
-            doc.add_heading(line[2:], level=1)
-        elif line.lstrip().startswith(("-", "*")):
-            doc.add_paragraph(line.lstrip()[1:].strip(), style="List Bullet")
-        else:
-            doc.add_paragraph(line.strip())
+# Matches one non-blank line, surrounding whitespace excluded. MULTILINE so
+# parse_markdown can scan a whole document with one finditer; [^\S\n] is
+# "whitespace but not newline", which keeps every match on its own line. A
+# backslash before a marker character makes the line a paragraph, markdown
+# style; _blocks_markdown writes such rows that way.
+LINE_RE = re.compile(
+    r"^[^\S\n]*(?:"
+    r"(?P<h>#{1,3}) [^\S\n]*(?P<htext>\S(?:[^\n]*\S)?)"
+    r"|(?P<bullet>[-*])[^\S\n]+(?P<btext>\S(?:[^\n]*\S)?)"
+    r"|(?P<num>\d+)\.[^\S\n]+(?P<ntext>\S(?:[^\n]*\S)?)"
+    r"|(?:\\(?=[-*#\d\\]))?(?P<ptext>\S(?:[^\n]*\S)?)"
+    r")[^\S\n]*$",
+    re.M,
+)
+
+
+def _block(m: "re.Match") -> tuple:
+    # The text group closes each alternative, so lastgroup says which matched.
+    kind = m.lastgroup
+    if kind == "htext":
+        return ("heading", len(m["h"]), m["htext"])
+    if kind == "btext":
+        return ("bullet", m["btext"])
+    if kind == "ntext":
+        return ("num", m["num"], m["ntext"])
+    return ("para", m["ptext"])
+
+
+def parse_line(line: str) -> Optional[tuple]:
+    """Classify one markdown line as a block shared by both renderers:
+    ("heading", level, text), ("bullet", text), ("num", number, text), ("para", text).
+    Blank lines give None.
+    """
+    m = LINE_RE.match(line)
+    return _block(m) if m else None
+
+
+def parse_markdown(md: str) -> Iterator[tuple]:
+    # Lazy: blocks are produced as the scan advances, so replaying a cached
+    # document never holds a list of its lines or blocks. Blank lines never
+    # match, so finditer yields exactly the blocks.
+    return map(_block, LINE_RE.finditer(md))
+
+
+class MarkdownStreamer:
+    """Splits streamed completion deltas into lines and emits parsed blocks."""
+
+    def __init__(self, on_block: Callable[[tuple], None]):
+        self.on_block = on_block
+        self._buf = ""
+
+    def feed(self, delta: str):
+        self._buf += delta
+        if "\n" not in self._buf:
+            return
+        *lines, self._buf = self._buf.split("\n")
+        for line in lines:
+            self._emit(line)
+
+    def close(self):
+        if self._buf:
+            self._emit(self._buf)
+            self._buf = ""
+
+    def _emit(self, line: str):
+        block = parse_line(line)
+        if block is not None:
+            self.on_block(block)
+
+
+class SectionPipe:
+    """Feeds parsed blocks to one builder off the event loop, a "## " section
+    at a time. A single consumer task per builder keeps sections in order
+    while the completion stream keeps being read.
+    """
+
+    def __init__(self, add: Callable[[tuple], None]):
+        self._add = add
+        self._section: List[tuple] = []
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._consume())
+
+    def put(self, block: tuple):
+        if block[0] == "heading" and block[1] <= 2 and self._section:
+            self._queue.put_nowait(self._section)
+            self._section = []
+        self._section.append(block)
+
+    async def close(self):
+        if self._section:
+            self._queue.put_nowait(self._section)
+            self._section = []
+        self._queue.put_nowait(None)
+        await self._task
+
+    def abort(self):
+        self._task.cancel()
+
+    async def _consume(self):
+        while (section := await self._queue.get()) is not None:
+            await asyncio.to_thread(self._run, section)
+
+    def _run(self, section: List[tuple]):
+        for block in section:
+            self._add(block)
+
+
+def _docx_skeleton() -> Tuple[List[Tuple[zipfile.ZipInfo, Optional[bytes]]], bytes, bytes]:
+    """Split python-docx's default template into (parts, body prefix, body suffix).
+    The word/document.xml entry keeps its place in parts with data None.
+    """
     buf = io.BytesIO()
-    doc.save(buf)
-    return buf.getvalue()
+    Document().save(buf)
+    parts = []
+    with zipfile.ZipFile(buf) as zf:
+        for info in zf.infolist():
+            if info.filename == "word/document.xml":
+                document_xml = zf.read(info).decode("utf-8")
+                parts.append((info, None))
+            else:
+                parts.append((info, zf.read(info)))
+    body_start = document_xml.index("<w:body>") + len("<w:body>")
+    body_end = document_xml.index("<w:sectPr")
+    return (
+        parts,
+        document_xml[:body_start].encode("utf-8"),
+        document_xml[body_end:].encode("utf-8"),
+    )
 
 
-def markdown_to_pdf(md: str) -> bytes:
-    buf = io.BytesIO()
-    c = canvas.Canvas(buf, pagesize=A4)
-    width, height = A4
-    x, y = 2 * cm, height - 2 * cm
-
-    def draw(text, bold=False):
-        nonlocal y
-        if y < 2 * cm:
-            c.showPage()
-            y = height - 2 * cm
-        c.setFont("Helvetica-Bold" if bold else "Helvetica", 11)
-        for i in range(0, len(text), 90):
-            c.drawString(x, y, text[i:i+90])
-            y -= 14
-
-    for line in md.splitlines():
-        if not line.strip():
+_DOCX_PARTS, _DOCX_BODY_PREFIX, _DOCX_BODY_SUFFIX = _docx_skeleton()
+
+_DOCX_PARAGRAPH = '<w:p>{ppr}<w:r><w:t xml:space="preserve">{text}</w:t></w:r></w:p>'
+_DOCX_STYLE = '<w:pPr><w:pStyle w:val="{}"/></w:pPr>'
+_DOCX_HEADING_PPR = {level: _DOCX_STYLE.format(f"Heading{level}") for level in (1, 2, 3)}
+_DOCX_BULLET_PPR = _DOCX_STYLE.format("ListBullet")
+# The template's ListNumber style points at one shared numbering definition,
+# so Word would count every numbered line in the document as one list. The
+# model's own number is kept as text instead, under the hanging-indent
+# "List" style, exactly as the PDF shows it.
+_DOCX_NUMBER_PPR = _DOCX_STYLE.format("List")
+
+# Applied after escaping. Other control characters are not allowed in XML
+# 1.0 text; tabs and line breaks become elements, as python-docx writes them.
+_DOCX_TEXT = str.maketrans({
+    **dict.fromkeys(range(32)),
+    "\t": '</w:t><w:tab/><w:t xml:space="preserve">',
+    "\n": '</w:t><w:br/><w:t xml:space="preserve">',
+    "\r": '</w:t><w:br/><w:t xml:space="preserve">',
+})
+
+
+class DocxBuilder:
+    """Writes word/document.xml directly; every other part comes from the
+    default python-docx template captured once at import.
+    """
+
+    def __init__(self):
+        # Encoded per paragraph so finish() never holds the whole body as a
+        # str and again as its UTF-8 copy.
+        self._body: List[bytes] = []
+
+    def _paragraph(self, ppr: str, text: str):
+        text = xml_escape(text).translate(_DOCX_TEXT)
+        self._body.append(_DOCX_PARAGRAPH.format(ppr=ppr, text=text).encode("utf-8"))
+
+    def add(self, block: tuple):
+        kind = block[0]
+        if kind == "heading":
+            self._paragraph(_DOCX_HEADING_PPR[block[1]], block[2])
+        elif kind == "bullet":
+            self._paragraph(_DOCX_BULLET_PPR, block[1])
+        elif kind == "num":
+            self._paragraph(_DOCX_NUMBER_PPR, f"{block[1]}. {block[2]}")
+        else:
+            self._paragraph("", block[1])
+
+    def finish(self) -> bytes:
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+            for template, data in _DOCX_PARTS:
+                # zipfile mutates the ZipInfo it is given (offsets, CRC), so
+                # concurrent builds each need their own.
+                info = zipfile.ZipInfo(template.filename, template.date_time)
+                info.compress_type = template.compress_type
+                info.external_attr = template.external_attr
+                if data is not None:
+                    zf.writestr(info, data)
+                    continue
+                with zf.open(info, "w") as member:
+                    member.write(_DOCX_BODY_PREFIX)
+                    member.write(b"".join(self._body))
+                    member.write(_DOCX_BODY_SUFFIX)
+        # BytesIO.getvalue() hands over its buffer without another copy.
+        return buf.getvalue()
+
+
+@functools.lru_cache(maxsize=65536)
+def _word_width(word: str, font: str, size: float) -> float:
+    return stringWidth(word, font, size)
+
+
+def _wrap_words(text: str, font: str, size: float, max_width: float) -> List[str]:
+    # The standard Type 1 fonts have no kerning, so a row is the sum of its
+    # words plus spaces: each distinct word is measured once, not every
+    # candidate row. Rows break only at spaces, and runs of spaces inside a
+    # row are kept as written, since ASCII diagrams line up on them.
+    space = _word_width(" ", font, size)
+    lines, current, used = [], [], 0.0
+    gap = -1  # spaces between the previous word and this one
+    for word in text.expandtabs(4).split(" "):
+        gap += 1
+        if not word:
+            continue
+        w = _word_width(word, font, size)
+        if current and used + gap * space + w <= max_width:
+            current.append(" " * gap + word)
+            used += gap * space + w
+            gap = 0
             continue
-        if line.startswith("#"):
-            draw(line.lstrip("# ").strip(), bold=True)
-        elif line.lstrip().startswith(("-", "*")):
-            draw("• " + line.lstrip()[1:].strip())
+        gap = 0
+        if current:
+            lines.append("".join(current))
+        if w <= max_width:
+            current, used = [word], w
+            continue
+        # Break words that are wider than a whole line on their own.
+        part, used = "", 0.0
+        for ch in word:
+            cw = _word_width(ch, font, size)
+            if part and used + cw > max_width:
+                lines.append(part)
+                part, used = "", 0.0
+            part += ch
+            used += cw
+        current = [part]
+    if current:
+        lines.append("".join(current))
+    return lines
+
+
+# Page streams stay Flate-compressed binary; the default ASCII85 wrapper only
+# makes them ~25% larger than the compressed data. notes.pdf goes into the
+# zip STORED, so this is the only compression it gets.
+rl_config.useA85 = 0
+
+# Font objects and their width tables are created on first use; do it at
+# import so no request pays for it. The DOCX side is prebuilt the same way
+# by _docx_skeleton.
+PDF_FONTS = ("Helvetica", "Helvetica-Bold")
+for _font in PDF_FONTS:
+    getFont(_font)
+    _word_width(" ", _font, 11)
+
+
+class PdfBuilder:
+    # One text object per page: rows become "T*"/Tj ops in a single BT..ET
+    # block, and Tf is only emitted when the font actually changes.
+    def __init__(self):
+        self.buf = io.BytesIO()
+        self.c = canvas.Canvas(self.buf, pagesize=A4)
+        self.width, self.height = A4
+        self.x, self.top = 2 * cm, self.height - 2 * cm
+        self.max_width = self.width - 2 * self.x
+        self._new_page_text()
+
+    def _new_page_text(self):
+        self.text = self.c.beginText(self.x, self.top)
+        self.font = None
+
+    def _draw(self, text: str, bold: bool = False):
+        font = "Helvetica-Bold" if bold else "Helvetica"
+        t = self.text
+        for row in _wrap_words(text, font, 11, self.max_width):
+            if t.getY() < 2 * cm:
+                self.c.drawText(t)
+                self.c.showPage()
+                self._new_page_text()
+                t = self.text
+            if font != self.font:
+                t.setFont(font, 11, 14)
+                self.font = font
+            t.textLine(row)
+
+    def add(self, block: tuple):
+        kind = block[0]
+        if kind == "heading":
+            self._draw(block[2], bold=True)
+        elif kind == "bullet":
+            self._draw("• " + block[1])
+        elif kind == "num":
+            self._draw(f"{block[1]}. {block[2]}")
         else:
-            draw(line.strip())
+            self._draw(block[1])
 
-    c.save()
-    return buf.getvalue()
+    def finish(self) -> bytes:
+        self.c.drawText(self.text)
+        self.c.save()
+        return self.buf.getvalue()
 
 
-def build_zip(docx: bytes, pdf: bytes) -> bytes:
-    buf = io.BytesIO()
-    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
-        z.writestr("notes.docx", docx)
-        z.writestr("notes.pdf", pdf)
-    return buf.getvalue()
+ZIP_CHUNK_SIZE = 64 * 1024
+
+
+class _ChunkSink(io.RawIOBase):
+    """Unseekable file object that collects whatever zipfile writes to it."""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> List[bytes]:
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def iter_zip(docx: bytes, pdf: bytes):
+    """Yield notes.zip in chunks as zipfile writes it, without building the
+    whole archive first. Used when zipstream-ng is not installed.
+    """
+    sink = _ChunkSink()
+    # Stored, like build_zip_stream: deflating DOCX/PDF again saves ~nothing.
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as z:
+        for name, data in (("notes.docx", docx), ("notes.pdf", pdf)):
+            with z.open(name, "w") as member:
+                for i in range(0, len(data), ZIP_CHUNK_SIZE):
+                    member.write(data[i:i + ZIP_CHUNK_SIZE])
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
+
+
+def build_zip_stream(docx: bytes, pdf: bytes) -> "ZipStream":
+    # DOCX is itself a deflated zip and PDF streams are Flate-compressed,
+    # so entries are stored rather than compressed a second time.
+    zs = ZipStream(compress_type=ZIP_STORED, sized=True)
+    zs.add(docx, "notes.docx")
+    zs.add(pdf, "notes.pdf")
+    return zs
+
+
+async def _iter_async(chunks):
+    # StreamingResponse runs sync iterators through the threadpool one chunk
+    # at a time; the zip is built from in-memory bytes, so yield directly.
+    for chunk in chunks:
+        yield chunk
 
 
 # =====================
@@ -293,31 +1675,58 @@ async def make_notes(request: Request, files: List[UploadFile] = File(...)):
         raise HTTPException(status_code=400, detail="Too many files")
 
     file_blobs = []
+    digests = []
+    remaining_total = MAX_TOTAL_MB * 1024 * 1024
     for f in files:
-        data = _read_uploadfile(f)
+        data, digest = await _read_uploadfile(f, remaining_total)
+        remaining_total -= len(data)
+        # The same lecture uploaded twice (e.g. re-exported under another
+        # name) is extracted and sent to the model only once.
+        if digest in digests:
+            continue
+        digests.append(digest)
         file_blobs.append((_safe_filename(f.filename), data))
-    _check_total_size(file_blobs)
 
-    extracted = []
-    for name, data in file_blobs:
-        text = extract_text(name, data)
-        extracted.append(f"=== File: {name} ===\n{text}")
-
-    source_text = "\n\n".join(extracted)
-
-    notes_md = call_ai_make_notes(source_text)
-    docx = markdown_to_docx(notes_md)
-    pdf = markdown_to_pdf(notes_md)
+    texts = dedup_paragraphs(await extract_all(file_blobs, digests))
+    extracted = [
+        f"=== File: {name} ===\n{text}"
+        for (name, _), text in zip(file_blobs, texts)
+    ]
+
+    source_text = await fit_source_to_budget(extracted)
+
+    # Both documents are built section by section in worker threads while
+    # the completion streams in; only the final serialisation is left once
+    # it ends.
+    docx_builder = DocxBuilder()
+    pdf_builder = PdfBuilder()
+    pipes = (SectionPipe(docx_builder.add), SectionPipe(pdf_builder.add))
+
+    def on_block(block: tuple):
+        for pipe in pipes:
+            pipe.put(block)
+
+    try:
+        await call_ai_make_notes(source_text, on_block)
+        await asyncio.gather(*(pipe.close() for pipe in pipes))
+    except BaseException:
+        for pipe in pipes:
+            pipe.abort()
+        raise
+    docx, pdf = await asyncio.gather(
+        asyncio.to_thread(docx_builder.finish),
+        asyncio.to_thread(pdf_builder.finish),
+    )
 
-    zip_bytes = build_zip(docx, pdf)
+    headers = {"Content-Disposition": 'attachment; filename="notes.zip"'}
+    if ZipStream is not None:
+        zs = build_zip_stream(docx, pdf)
+        headers["Content-Length"] = str(len(zs))
+        return StreamingResponse(_iter_async(zs), media_type="application/zip", headers=headers)
 
-    return StreamingResponse(
-        io.BytesIO(zip_bytes),
-        media_type="application/zip",
-        headers={"Content-Disposition": 'attachment; filename="notes.zip"'}
-    )
+    return StreamingResponse(_iter_async(iter_zip(docx, pdf)), media_type="application/zip", headers=headers)
 
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(_, exc: HTTPException):
-    return JSONResponse(status_code=exc.status_code, content={"error": exc.detail})
+    return ORJSONResponse(status_code=exc.status_code, content={"error": exc.detail})
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# main reads its configuration at import time.
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("STRUCTURED_OUTPUT", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
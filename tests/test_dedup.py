@@ -0,0 +1,50 @@
+import io
+
+from docx import Document
+from pptx import Presentation
+
+import main
+
+SHARED = "Renal clearance scales with creatinine clearance in most adults."
+DISCLAIMER = "These notes are for teaching only and are not clinical guidance."
+
+
+def _pptx(bodies):
+    prs = Presentation()
+    for body in bodies:
+        slide = prs.slides.add_slide(prs.slide_layouts[1])
+        slide.shapes.title.text = "Dosing"
+        slide.placeholders[1].text = body
+    buf = io.BytesIO()
+    prs.save(buf)
+    return buf.getvalue()
+
+
+def _docx(paragraphs):
+    doc = Document()
+    for text in paragraphs:
+        doc.add_paragraph(text)
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
+def test_repeated_slide_at_another_position_is_dropped():
+    first = main.extract_text("a.pptx", _pptx([SHARED, "Hepatic metabolism varies with CYP2D6 genotype."]))
+    second = main.extract_text("b.pptx", _pptx(["Loading doses depend on the volume of distribution.", SHARED]))
+    a, b = main.dedup_paragraphs([first, second])
+    assert a == first
+    assert SHARED not in b
+    assert "Slide 1:" in b and "Slide 2:" not in b
+
+
+def test_repeated_docx_paragraph_is_dropped():
+    first = main.extract_text("a.docx", _docx(["Week 1", "Absorption follows first-order kinetics here.", DISCLAIMER]))
+    second = main.extract_text("b.docx", _docx(["Week 1", DISCLAIMER, "Elimination half-life sets the dosing interval."]))
+    a, b = main.dedup_paragraphs([first, second])
+    assert a == first
+    assert b == "Week 1\n\nElimination half-life sets the dosing interval."
+
+
+def test_short_paragraphs_are_kept():
+    assert main.dedup_paragraphs(["Summary", "Summary"]) == ["Summary", "Summary"]
@@ -0,0 +1,38 @@
+import io
+
+from docx import Document
+
+import main
+
+
+def _build(blocks):
+    builder = main.DocxBuilder()
+    for block in blocks:
+        builder.add(block)
+    return Document(io.BytesIO(builder.finish()))
+
+
+def test_every_block_kind_reopens_with_its_style():
+    blocks = [
+        ("heading", 1, "Pharmacology & <Therapeutics>"),
+        ("heading", 2, "Week 1"),
+        ("heading", 3, "Absorption"),
+        ("bullet", "Bioavailability F < 1 & varies"),
+        ("num", "3", "Third step"),
+        ("para", "A --> B"),
+    ]
+    doc = _build(blocks)
+    assert [(p.style.name, p.text) for p in doc.paragraphs] == [
+        ("Heading 1", "Pharmacology & <Therapeutics>"),
+        ("Heading 2", "Week 1"),
+        ("Heading 3", "Absorption"),
+        ("List Bullet", "Bioavailability F < 1 & varies"),
+        ("List", "3. Third step"),
+        ("Normal", "A --> B"),
+    ]
+
+
+def test_control_characters_are_dropped_and_tabs_kept():
+    doc = _build([("para", "bell\x07 form\x0cfeed\x00"), ("bullet", "dose\t5 mg")])
+    assert [p.text for p in doc.paragraphs] == ["bell formfeed", "dose\t5 mg"]
+    assert doc.paragraphs[1]._p.xpath(".//w:tab")
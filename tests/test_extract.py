@@ -0,0 +1,41 @@
+import asyncio
+import io
+import os
+
+import pytest
+from pptx import Presentation
+
+import main
+
+
+@pytest.mark.skipif(main.EXTRACT_EXECUTOR == "thread", reason="needs the process pool")
+def test_pool_is_replaced_after_a_worker_dies():
+    async def run():
+        broken = main.extract_pool
+        with pytest.raises(main.BrokenProcessPool):
+            await asyncio.get_running_loop().run_in_executor(broken, os._exit, 1)
+        texts = await main.extract_all([("a.txt", b"hi")], ["d0"])
+        return broken, texts
+
+    broken, texts = asyncio.run(run())
+    assert texts == ["hi"]
+    assert main.extract_pool is not broken
+
+
+def _pptx(body, notes):
+    prs = Presentation()
+    slide = prs.slides.add_slide(prs.slide_layouts[1])
+    slide.shapes.title.text = "Title"
+    slide.placeholders[1].text = body
+    slide.notes_slide.notes_text_frame.text = notes
+    buf = io.BytesIO()
+    prs.save(buf)
+    return buf.getvalue()
+
+
+def test_pptx_line_breaks_are_kept():
+    # "\v" is how python-pptx writes an a:br inside one paragraph.
+    data = _pptx("line one\vline two\nnext paragraph", "note one\vnote two")
+    text = main._extract_pptx_xml(data)
+    assert text == "Slide 1:\nTitle\nline one\nline two\nnext paragraph\n(Notes) note one\nnote two"
+    assert main._extract_pptx_object_model(data) == text
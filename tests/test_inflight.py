@@ -0,0 +1,135 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+NOTES = "# Title\n- one\n1. first\nA paragraph."
+
+
+def _chunk(content=None, usage=None):
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=content))] if content else []
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+async def _stream(text):
+    for i in range(0, len(text), 5):
+        await asyncio.sleep(0)
+        yield _chunk(text[i:i + 5])
+
+
+class FakeRaw:
+    def __init__(self, value, headers=None):
+        self.value = value
+        self.headers = headers or {}
+
+    def parse(self):
+        return self.value
+
+
+class FakeCompletions:
+    """Stands in for client.chat.completions; each call waits on `gate`."""
+
+    def __init__(self):
+        self.calls = 0
+        self.gate = asyncio.Event()
+        self.error = None
+        self.with_raw_response = SimpleNamespace(create=self.create)
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        await self.gate.wait()
+        if self.error is not None:
+            raise self.error
+        return FakeRaw(_stream(NOTES))
+
+
+@pytest.fixture
+def completions(monkeypatch):
+    fake = FakeCompletions()
+    monkeypatch.setattr(main, "client", SimpleNamespace(chat=SimpleNamespace(completions=fake)))
+    monkeypatch.setattr(main, "_rate_limiters", {})
+    monkeypatch.setattr(main, "CACHE_LLM", False)
+    return fake
+
+
+async def _settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_duplicate_requests_share_one_completion(completions):
+    async def run():
+        blocks = [[], [], []]
+        tasks = [asyncio.create_task(main.call_ai_make_notes("same source", b.append)) for b in blocks]
+        await _settle()
+        completions.gate.set()
+        return await asyncio.gather(*tasks), blocks
+
+    results, blocks = asyncio.run(run())
+    assert completions.calls == 1
+    assert results == [NOTES] * 3
+    assert blocks[0] == blocks[1] == blocks[2] == list(main.parse_markdown(NOTES))
+    assert main._inflight == {}
+
+
+def test_different_sources_are_not_coalesced(completions):
+    async def run():
+        tasks = [asyncio.create_task(main.call_ai_make_notes(f"source {i}")) for i in range(2)]
+        await _settle()
+        completions.gate.set()
+        return await asyncio.gather(*tasks)
+
+    assert asyncio.run(run()) == [NOTES] * 2
+    assert completions.calls == 2
+
+
+def test_cancelled_leader_hands_off_to_a_waiter(completions):
+    async def run():
+        leader = asyncio.create_task(main.call_ai_make_notes("same source"))
+        await _settle()
+        follower = asyncio.create_task(main.call_ai_make_notes("same source"))
+        await _settle()
+        leader.cancel()
+        await _settle()
+        completions.gate.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(run()) == NOTES
+    assert completions.calls == 2
+    assert main._inflight == {}
+
+
+def test_cancelled_waiter_leaves_the_leader_running(completions):
+    async def run():
+        leader = asyncio.create_task(main.call_ai_make_notes("same source"))
+        await _settle()
+        follower = asyncio.create_task(main.call_ai_make_notes("same source"))
+        await _settle()
+        follower.cancel()
+        await _settle()
+        completions.gate.set()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+        return await leader
+
+    assert asyncio.run(run()) == NOTES
+    assert completions.calls == 1
+
+
+def test_error_fans_out_to_every_waiter(completions):
+    completions.error = RuntimeError("boom")
+
+    async def run():
+        tasks = [asyncio.create_task(main.call_ai_make_notes("same source")) for _ in range(3)]
+        await _settle()
+        completions.gate.set()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert completions.calls == 1
+    assert all(isinstance(r, RuntimeError) and str(r) == "boom" for r in results)
+    assert main._inflight == {}
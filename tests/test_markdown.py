@@ -0,0 +1,40 @@
+import pytest
+
+import main
+from main import NoteItem, NoteSection, NotesDoc
+
+ROWS = [
+    "- not a bullet",
+    "* not a bullet either",
+    "1. not numbered",
+    "2024 was a leap year",
+    "# not a heading",
+    "### nor this",
+    "#hashtag",
+    "\\frac{a}{b}",
+    "\\- already escaped",
+    "\\",
+    "A --> B --> C",
+]
+
+
+@pytest.mark.parametrize("row", ROWS)
+def test_paragraph_rows_replay_as_paragraphs(row):
+    blocks = [("heading", 1, "Title"), ("para", row), ("bullet", "after")]
+    assert list(main.parse_markdown(main._blocks_markdown(blocks))) == blocks
+
+
+def test_structured_doc_round_trips():
+    doc = NotesDoc(sections=[NoteSection(heading="Dosing", level=2, items=[
+        NoteItem(kind="numbered", text="first"),
+        NoteItem(kind="numbered", text="second"),
+        NoteItem(kind="paragraph", text="\n".join(ROWS)),
+        NoteItem(kind="numbered", text="restarts"),
+        NoteItem(kind="bullet", text="point"),
+    ])])
+    blocks = list(main._doc_blocks(doc))
+    md = main._blocks_markdown(blocks)
+    assert list(main.parse_markdown(md)) == blocks
+    # The streaming path classifies line by line.
+    assert [main.parse_line(line) for line in md.split("\n")] == blocks
+    assert [b[1] for b in blocks if b[0] == "num"] == ["1", "2", "1"]
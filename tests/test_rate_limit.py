@@ -0,0 +1,102 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+class FakeRaw:
+    def __init__(self, value, headers=None):
+        self.value = value
+        self.headers = headers or {}
+
+    def parse(self):
+        return self.value
+
+
+def _rate_limit_error(retry_after_ms):
+    response = SimpleNamespace(request=None, status_code=429, headers={"retry-after-ms": str(retry_after_ms)})
+    return main.RateLimitError("rate limited", response=response, body=None)
+
+
+async def _settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_429_pauses_every_caller():
+    limiter = main.RateLimiter(4, 0, 0)
+    started = []
+    failed = asyncio.Event()
+
+    async def fn():
+        started.append(time.monotonic())
+        if len(started) == 1:
+            failed.set()
+            raise _rate_limit_error(200)
+        return FakeRaw("ok")
+
+    async def later():
+        await failed.wait()
+        return await limiter.call(fn)
+
+    async def run():
+        return await asyncio.gather(limiter.call(fn), later())
+
+    assert asyncio.run(run()) == ["ok", "ok"]
+    assert len(started) == 3
+    assert min(started[1:]) - started[0] >= 0.19
+
+
+def test_429_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(main, "OPENAI_MAX_RETRIES", 1)
+    limiter = main.RateLimiter(4, 0, 0)
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        raise _rate_limit_error(1)
+
+    with pytest.raises(main.RateLimitError):
+        asyncio.run(limiter.call(fn))
+    assert len(calls) == 2
+
+
+def test_budget_is_learned_from_headers():
+    limiter = main.RateLimiter(4, 0, 0)
+    headers = {"x-ratelimit-limit-requests": "600", "x-ratelimit-remaining-requests": "0"}
+    started = []
+
+    async def fn():
+        started.append(time.monotonic())
+        return FakeRaw("ok", headers)
+
+    async def run():
+        await limiter.call(fn)
+        await limiter.call(fn)
+
+    asyncio.run(run())
+    # 600 requests a minute with none remaining: the next one waits ~0.1 s.
+    assert started[1] - started[0] >= 0.09
+
+
+def test_models_are_paced_separately(monkeypatch):
+    monkeypatch.setattr(main, "_rate_limiters", {})
+    started = {}
+
+    async def fn(model):
+        started.setdefault(model, []).append(time.monotonic())
+        if model == "chat" and len(started[model]) == 1:
+            raise _rate_limit_error(300)
+        return FakeRaw(model)
+
+    async def run():
+        chat = asyncio.create_task(main.throttled_call(fn, model="chat"))
+        await _settle()
+        return await asyncio.gather(chat, main.throttled_call(fn, model="embed"))
+
+    assert asyncio.run(run()) == ["chat", "embed"]
+    assert started["embed"][0] - started["chat"][0] < 0.1
+    assert started["chat"][1] - started["chat"][0] >= 0.29
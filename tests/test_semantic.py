@@ -0,0 +1,88 @@
+import asyncio
+import zlib
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import main
+
+pytestmark = pytest.mark.skipif(main.faiss is None, reason="faiss not installed")
+
+
+class FakeRaw:
+    headers = {}
+
+    def __init__(self, value):
+        self.value = value
+
+    def parse(self):
+        return self.value
+
+
+class FakeEmbeddings:
+    """Deterministic pseudo-random embedding per chunk, of any dimension."""
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.inputs = []
+        self.with_raw_response = SimpleNamespace(create=self.create)
+
+    async def create(self, model, input):
+        self.inputs.append(input)
+        data = []
+        for i, chunk in enumerate(input):
+            rng = np.random.default_rng(zlib.crc32(chunk.encode()))
+            data.append(SimpleNamespace(index=i, embedding=rng.standard_normal(self.dim).tolist()))
+        return FakeRaw(SimpleNamespace(data=data))
+
+
+@pytest.fixture
+def embeddings(monkeypatch):
+    fake = FakeEmbeddings(3072)
+    monkeypatch.setattr(main, "client", SimpleNamespace(embeddings=fake))
+    monkeypatch.setattr(main, "_rate_limiters", {})
+    monkeypatch.setattr(main, "semantic_cache", main.SemanticCache(10))
+    monkeypatch.setattr(main, "EMBEDDING_CHUNK_TOKENS", 50)
+    return fake
+
+
+def _lecture(name):
+    return " ".join(f"{name} sentence {i} about pharmacokinetics." for i in range(200))
+
+
+def test_whole_text_is_embedded(embeddings):
+    text = _lecture("one")
+    asyncio.run(main._embed(text))
+    (chunks,) = embeddings.inputs
+    assert len(chunks) > 1
+    assert "".join(chunks) == text
+
+
+def test_index_is_sized_from_the_first_embedding(embeddings):
+    text = _lecture("one")
+
+    async def run():
+        _, vec = await main.semantic_lookup(text)
+        await main.semantic_store(vec, text, "# Notes")
+        return await main.semantic_lookup(text)
+
+    notes, vec = asyncio.run(run())
+    assert notes == "# Notes"
+    assert vec.shape == (1, 3072)
+    assert main.semantic_cache.size == 1
+
+
+def test_upload_extending_a_cached_one_misses(embeddings, monkeypatch):
+    first = _lecture("one")
+    both = first + "\n\n" + _lecture("two")
+
+    async def run():
+        _, vec = await main.semantic_lookup(first)
+        await main.semantic_store(vec, first, "# Lecture one")
+        return await main.semantic_lookup(both)
+
+    assert asyncio.run(run())[0] is None
+    # Even with the length guard off, the second lecture moves the embedding.
+    monkeypatch.setattr(main, "SEMANTIC_LENGTH_TOLERANCE", 1.0)
+    assert asyncio.run(main.semantic_lookup(both))[0] is None
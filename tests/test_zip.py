@@ -0,0 +1,18 @@
+import io
+import zipfile
+
+import main
+
+
+def test_iter_zip_writes_a_valid_stored_archive():
+    docx = bytes(range(256)) * 1000
+    pdf = b"%PDF-1.4 body"
+    chunks = list(main.iter_zip(docx, pdf))
+    assert len(chunks) > 1
+    assert max(map(len, chunks)) <= main.ZIP_CHUNK_SIZE + 1024
+    with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as z:
+        assert z.testzip() is None
+        assert z.namelist() == ["notes.docx", "notes.pdf"]
+        assert z.read("notes.docx") == docx
+        assert z.read("notes.pdf") == pdf
+        assert {info.compress_type for info in z.infolist()} == {zipfile.ZIP_STORED}